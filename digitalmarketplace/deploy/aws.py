@@ -8,13 +8,14 @@ from collections import namedtuple
 
 from boto import beanstalk, ec2, s3, rds2
 from boto.s3.key import Key
-from boto.exception import S3CreateError, BotoServerError
+from boto.exception import S3CreateError, BotoServerError, EC2ResponseError
 
-from . import git
+from . import git, history
 
 
 DEFAULT_SOLUTION_STACK = '64bit Amazon Linux 2016.03 v2.1.0 running Python 2.7'
 DEFAULT_ENVIRONMENT_NAMES = ['staging', 'production']
+ENVIRONMENT_READY_TIMEOUT = 30 * 60
 
 
 def get_client(region):
@@ -37,12 +38,17 @@ class Client(object):
     def bootstrap(self, proxy_env, db_name, db_username, db_password):
         """Bootstrap a new application"""
         self.s3.create_bucket(self.application_name)
-        self.beanstalk.create_application(self.application_name)
+        try:
+            self.beanstalk.create_application(self.application_name)
+        except ApplicationAlreadyExists:
+            logging.info("Beanstalk application {} already exists".format(
+                self.application_name))
         self.beanstalk.create_configuration_template(
             self.application_name, 'default',
             solution_stack=DEFAULT_SOLUTION_STACK,
             environ=dict(
-                (env_name, os.environ[env_name]) for env_name in proxy_env))
+                (env_name, os.environ[env_name]) for env_name in proxy_env),
+            reconcile=True)
 
         version_label = self.create_version(
             'initial',
@@ -126,26 +132,126 @@ class Client(object):
                 'RDS_PASSWORD': db_info.password,
                 'RDS_HOSTNAME': db_info.host,
                 'RDS_PORT': db_info.port,
-            })
-        self.beanstalk.create_environment(
-            self.application_name, environment_name, version_label,
-            template_name=environment_name)
+            },
+            reconcile=True)
+
+        environment = self.beanstalk.describe_environment(
+            self.application_name, environment_name)
+        if environment is None or environment['Status'] == 'Terminated':
+            self.beanstalk.create_environment(
+                self.application_name, environment_name, version_label,
+                template_name=environment_name)
+        else:
+            logging.info("Beanstalk environment {} already exists".format(
+                environment_name))
 
         logging.info("Giving Beanstalk environment access to RDS instance")
         rds_security_group = self.rds.get_security_group(environment_name)
         self.beanstalk.wait_for_security_group(environment_name)
         eb_security_group = self.beanstalk.get_security_group(environment_name)
 
-        rds_security_group.authorize(
-            ip_protocol='tcp',
-            from_port=db_info.port,
-            to_port=db_info.port,
-            src_group=eb_security_group)
+        try:
+            rds_security_group.authorize(
+                ip_protocol='tcp',
+                from_port=db_info.port,
+                to_port=db_info.port,
+                src_group=eb_security_group)
+        except EC2ResponseError as e:
+            if e.error_code != 'InvalidPermission.Duplicate':
+                raise
+
+    def update_config(self, environment_short_name, proxy_env):
+        """Apply changed environment variables to a running environment"""
+        environment_name = self._get_env_name(environment_short_name)
+        self.beanstalk.update_environment_configuration(
+            self.application_name, environment_name,
+            environ=dict(
+                (env_name, os.environ[env_name]) for env_name in proxy_env))
 
     def deploy(self, version_label, environment_short_name):
+        version = self.beanstalk.describe_application_version(
+            self.application_name, version_label)
+        if version is None:
+            raise AWSError('Version {} does not exist'.format(version_label))
+        source_bundle = version['SourceBundle']
+        self._deploy(version_label, environment_short_name,
+                     source_bundle['S3Bucket'], source_bundle['S3Key'])
+
+    def rollback(self, environment_short_name):
+        """Redeploy the last known-good version from the local history"""
+        entries = self._load_history()
+        current = history.get_current_deployment(entries,
+                                                 environment_short_name)
+        if current is None:
+            raise AWSError(
+                'No previous deployment to {} recorded in {}'.format(
+                    environment_short_name,
+                    history.get_history_path(self.application_name)))
+        entry = history.get_rollback_target(entries, environment_short_name)
+        if entry is None:
+            raise AWSError(
+                'No known-good deployment of {} to roll back to in {}'.format(
+                    environment_short_name,
+                    history.get_history_path(self.application_name)))
+
+        current_label = current['version_label']
+        environment = self.beanstalk.describe_environment(
+            self.application_name,
+            self._get_env_name(environment_short_name),
+            include_deleted=False)
+        if environment is None:
+            raise AWSError(
+                'Environment {} does not exist'.format(environment_short_name))
+        if environment['VersionLabel'] != current_label:
+            raise AWSError(
+                '{} is running {} but the local history records {}; it may '
+                'have been deployed from elsewhere'.format(
+                    environment_short_name, environment['VersionLabel'],
+                    current_label))
+
+        if not self.s3.package_exists(entry['s3_bucket'], entry['s3_key']):
+            raise AWSError('Package {}/{} for version {} no longer '
+                           'exists'.format(entry['s3_bucket'],
+                                           entry['s3_key'],
+                                           entry['version_label']))
+
+        logging.info("Rolling back {} from {} to {}".format(
+            environment_short_name, current_label, entry['version_label']))
+        self._deploy(entry['version_label'], environment_short_name,
+                     entry['s3_bucket'], entry['s3_key'],
+                     rolled_back_from=current_label)
+
+    def _deploy(self, version_label, environment_short_name,
+                s3_bucket, s3_key, rolled_back_from=None):
         environment_name = self._get_env_name(environment_short_name)
+        entries = self._load_history()
+        start = time.time()
         self.beanstalk.update_environment(environment_name, version_label)
 
+        # Record before waiting so an interrupted deploy still matches
+        # what the environment is running
+        entry = history.add_deployment(
+            entries, environment_short_name, version_label,
+            s3_bucket, s3_key, rolled_back_from=rolled_back_from)
+        history.save(self.application_name, entries)
+
+        logging.info("Waiting for {} to be ready".format(environment_name))
+        environment = self.beanstalk.wait_for_environment_ready(
+            self.application_name, environment_name)
+        logging.info("{} is ready with health {}".format(
+            environment_name, environment['Health']))
+        history.complete_deployment(entry, time.time() - start,
+                                    environment['Health'])
+        history.save(self.application_name, entries)
+
+    def _load_history(self):
+        try:
+            return history.load(self.application_name)
+        except ValueError:
+            raise AWSError(
+                'Deployment history {} is corrupt; fix or remove it'.format(
+                    history.get_history_path(self.application_name)))
+
     def deploy_latest_to_staging(self):
         version_label = self.get_latest_release_version()
         self.deploy(version_label, 'staging')
@@ -226,6 +332,10 @@ class S3Client(object):
 
         return application_name, key.key
 
+    def package_exists(self, bucket_name, key_name):
+        bucket = self._connection.get_bucket(bucket_name, validate=False)
+        return bucket.get_key(key_name) is not None
+
 
 class BeanstalkClient(object):
 
@@ -261,10 +371,15 @@ class BeanstalkClient(object):
                                       solution_stack=None,
                                       source_configuration=None,
                                       option_settings=None,
-                                      environ=None):
-        logging.info(
-            "Creating Beanstalk configuration template {} in {}".format(
-                template_name, application_name))
+                                      environ=None,
+                                      reconcile=False):
+        """Create a configuration template
+
+        With ``reconcile`` set an existing template is updated in place
+        instead: only options whose values differ from the current
+        template settings are sent, in a single update call, and nothing
+        is sent if the template is already up to date.
+        """
         kwargs = dict()
         if source_configuration is not None:
             if solution_stack is not None:
@@ -278,18 +393,138 @@ class BeanstalkClient(object):
             raise AWSError('Must select either source config or '
                            'solution stack')
 
-        if option_settings is None:
-            option_settings = []
+        option_settings = self._build_option_settings(option_settings,
+                                                      environ)
+        if reconcile:
+            configuration = self._describe_configuration(
+                application_name, template_name=template_name)
+            if configuration is not None:
+                if solution_stack is not None and \
+                        configuration['SolutionStackName'] != solution_stack:
+                    logging.warning(
+                        "Configuration template {} uses solution stack {}, "
+                        "not {}; the solution stack will not be "
+                        "changed".format(template_name,
+                                         configuration['SolutionStackName'],
+                                         solution_stack))
+                return self._reconcile_configuration_template(
+                    application_name, template_name,
+                    self._get_option_values(configuration), option_settings)
+
+        logging.info(
+            "Creating Beanstalk configuration template {} in {}".format(
+                template_name, application_name))
+        self._connection.create_configuration_template(
+            application_name, template_name,
+            option_settings=option_settings,
+            **kwargs)
+
+    def _build_option_settings(self, option_settings, environ):
+        option_settings = list(option_settings or [])
         if environ is not None:
             for key, value in environ.items():
                 option_settings.append((
                     'aws:elasticbeanstalk:application:environment',
                     key, value))
+        return option_settings
+
+    def _diff_option_settings(self, current_settings, option_settings):
+        return [
+            (namespace, option_name, value)
+            for namespace, option_name, value in option_settings
+            if current_settings.get((namespace, option_name)) != str(value)]
+
+    def _reconcile_configuration_template(self, application_name,
+                                          template_name, current_settings,
+                                          option_settings):
+        changed_settings = self._diff_option_settings(current_settings,
+                                                      option_settings)
+        if not changed_settings:
+            logging.info(
+                "Beanstalk configuration template {} in {} is up to "
+                "date".format(template_name, application_name))
+            return
 
-        self._connection.create_configuration_template(
+        logging.info(
+            "Updating {} options in Beanstalk configuration template "
+            "{} in {}".format(len(changed_settings),
+                              template_name, application_name))
+        self._connection.update_configuration_template(
             application_name, template_name,
-            option_settings=option_settings,
-            **kwargs)
+            option_settings=changed_settings)
+
+    def update_environment_configuration(self, application_name,
+                                         environment_name,
+                                         option_settings=None,
+                                         environ=None):
+        """Apply changed options directly to a running environment
+
+        Only options whose values differ from the environment's current
+        settings are sent, in a single update call, and nothing is sent
+        if the environment is already up to date.
+        """
+        option_settings = self._build_option_settings(option_settings,
+                                                      environ)
+        current_settings = self.get_configuration_settings(
+            application_name, environment_name=environment_name)
+        if current_settings is None:
+            raise AWSError(
+                'Environment {} does not exist'.format(environment_name))
+
+        changed_settings = self._diff_option_settings(current_settings,
+                                                      option_settings)
+        if not changed_settings:
+            logging.info("Configuration of {} is up to date".format(
+                environment_name))
+            return
+
+        try:
+            logging.info("Updating {} options in {}".format(
+                         len(changed_settings), environment_name))
+            self._connection.update_environment(
+                environment_name=environment_name,
+                option_settings=changed_settings)
+        except BotoServerError as e:
+            if self._environment_not_ready(e):
+                raise EnvironmentNotReady(e.message)
+            else:
+                raise
+
+    def get_configuration_settings(self, application_name,
+                                   template_name=None, environment_name=None):
+        """Return the current option settings of a template or environment
+
+        Settings are keyed by ``(namespace, option name)``. Returns ``None``
+        if the template or environment does not exist.
+        """
+        configuration = self._describe_configuration(
+            application_name,
+            template_name=template_name,
+            environment_name=environment_name)
+        if configuration is not None:
+            return self._get_option_values(configuration)
+
+    def _describe_configuration(self, application_name, **kwargs):
+        try:
+            response = self._connection.describe_configuration_settings(
+                application_name=application_name, **kwargs)
+        except BotoServerError as e:
+            if self._configuration_not_found(e):
+                return None
+            raise
+        response = response['DescribeConfigurationSettingsResponse']
+        result = response['DescribeConfigurationSettingsResult']
+        configuration_settings = result['ConfigurationSettings']
+
+        if configuration_settings:
+            return configuration_settings[0]
+
+    def _get_option_values(self, configuration):
+        settings = dict()
+        for option in configuration['OptionSettings'] or []:
+            key = (option['Namespace'], option['OptionName'])
+            settings[key] = option.get('Value')
+        return settings
 
     def delete_configuration_template(self, application_name, environment_name):
         logging.info(
@@ -297,17 +532,23 @@ class BeanstalkClient(object):
         self._connection.delete_configuration_template(application_name,
                                                        environment_name)
 
-    def describe_environment(self, application_name, environment_name):
-        for environment in self.list_environments(application_name):
+    def describe_environment(self, application_name, environment_name,
+                             include_deleted=True):
+        for environment in self.list_environments(application_name,
+                                                  include_deleted):
             if environment['EnvironmentName'] == environment_name:
                 return environment
 
-    def list_environments(self, application_name):
-        response = self._connection.describe_environments(application_name)
+    def list_environments(self, application_name, include_deleted=True):
+        response = self._connection.describe_environments(
+            application_name, include_deleted=include_deleted)
         response = response['DescribeEnvironmentsResponse']
         result = response['DescribeEnvironmentsResult']
         environments = result['Environments']
 
+        if not include_deleted:
+            environments = [environment for environment in environments
+                            if environment['Status'] != 'Terminated']
         return environments
 
     def update_environment(self, environment_name, version_label):
@@ -344,6 +585,16 @@ class BeanstalkClient(object):
 
         return versions
 
+    def describe_application_version(self, application_name, version_label):
+        response = self._connection.describe_application_versions(
+            application_name, version_labels=[version_label])
+        response = response['DescribeApplicationVersionsResponse']
+        result = response['DescribeApplicationVersionsResult']
+        versions = result['ApplicationVersions']
+
+        if versions:
+            return versions[0]
+
     def create_application_version(self, application_name, version_label,
                                    s3_bucket, s3_key, description):
         try:
@@ -355,6 +606,24 @@ class BeanstalkClient(object):
             if not self._application_version_already_exists(e):
                 raise
 
+    def wait_for_environment_ready(self, application_name, environment_name,
+                                   timeout=ENVIRONMENT_READY_TIMEOUT):
+        deadline = time.time() + timeout
+        while True:
+            environment = self.describe_environment(
+                application_name, environment_name, include_deleted=False)
+            if environment is None or \
+                    environment['Status'] in ('Terminating', 'Terminated'):
+                raise AWSError(
+                    'Environment {} is not running'.format(environment_name))
+            if environment['Status'] == 'Ready':
+                return environment
+            if time.time() > deadline:
+                raise AWSError(
+                    'Timed out after {} seconds waiting for {} to be '
+                    'ready'.format(timeout, environment_name))
+            time.sleep(10)
+
     def wait_for_security_group(self, environment_name):
         while self.get_security_group(environment_name) is None:
             time.sleep(2)
@@ -394,6 +663,12 @@ class BeanstalkClient(object):
             return False
         return re.match(r'Environment .* already exists.', e.message)
 
+    def _configuration_not_found(self, e):
+        if e.error_code != 'InvalidParameterValue':
+            return False
+        return re.match(r'No (Configuration Template named|Environment found)',
+                        e.message)
+
     def _application_version_already_exists(self, e):
         if e.error_code != 'InvalidParameterValue':
             return False
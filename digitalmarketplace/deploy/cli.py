@@ -51,6 +51,13 @@ def terminate_branch_environment(branch=None, region=None):
     aws.get_client(region).terminate_branch_environment(branch)
 
 
+@argh.arg('environment', help='Environment short name, eg. production')
+@proxy_env_arg
+def update_config(environment, proxy_env=None, region=None):
+    """Apply changed environment variables to a running environment"""
+    aws.get_client(region).update_config(environment, proxy_env)
+
+
 def deploy_latest_to_staging(region=None):
     """Deploy latest release version to the staging environment"""
     aws.get_client(region).deploy_latest_to_staging()
@@ -71,6 +78,12 @@ def deploy_to_production(version_label, region=None):
     aws.get_client(region).deploy(version_label, 'production')
 
 
+@argh.arg('environment', help='Environment short name, eg. production')
+def rollback(environment, region=None):
+    """Redeploy the last known-good version to an environment"""
+    aws.get_client(region).rollback(environment)
+
+
 def main():
     logging.basicConfig(level=logging.INFO)
 
@@ -81,10 +94,12 @@ def main():
         create_version,
         deploy_to_branch_environment,
         terminate_branch_environment,
+        update_config,
         deploy_latest_to_staging,
         deploy_staging_to_production,
         deploy_to_staging,
-        deploy_to_production])
+        deploy_to_production,
+        rollback])
     try:
         parser.dispatch()
     except aws.AWSError as e:
@@ -0,0 +1,102 @@
+# Local deployment history
+import os
+import json
+import datetime
+
+HISTORY_DIR = os.path.expanduser('~/.dm-deploy')
+
+
+def get_history_path(application_name):
+    return os.path.join(HISTORY_DIR, '{}.json'.format(application_name))
+
+
+def load(application_name):
+    """Return the recorded deployments of an application
+
+    Raises ``ValueError`` if the history file is corrupt.
+    """
+    path = get_history_path(application_name)
+    if not os.path.exists(path):
+        return []
+    with open(path) as history_file:
+        return json.load(history_file)
+
+
+def save(application_name, entries):
+    path = get_history_path(application_name)
+    if not os.path.isdir(HISTORY_DIR):
+        os.makedirs(HISTORY_DIR)
+    tmp_path = '{}.tmp'.format(path)
+    with open(tmp_path, 'w') as history_file:
+        json.dump(entries, history_file, indent=2)
+    os.rename(tmp_path, path)
+
+
+def add_deployment(entries, environment_short_name, version_label,
+                   s3_bucket, s3_key, rolled_back_from=None):
+    """Append a pending deployment to the entries and return it"""
+    entry = {
+        'environment': environment_short_name,
+        'version_label': version_label,
+        'sha': get_sha_from_key(s3_key),
+        's3_bucket': s3_bucket,
+        's3_key': s3_key,
+        'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+        'status': 'pending',
+        'duration': None,
+        'health': None,
+        'rolled_back_from': rolled_back_from,
+    }
+    entries.append(entry)
+    return entry
+
+
+def complete_deployment(entry, duration, health):
+    entry['status'] = 'complete'
+    entry['duration'] = round(duration, 2)
+    entry['health'] = health
+
+
+def get_sha_from_key(s3_key):
+    """Return the commit sha from a package key
+
+    Packages are uploaded as ``{sha}.zip``, see ``git.create_package``.
+    """
+    if s3_key is None:
+        return None
+    return os.path.splitext(s3_key)[0]
+
+
+def get_deployments(entries, environment_short_name):
+    return [entry for entry in entries
+            if entry['environment'] == environment_short_name]
+
+
+def get_current_deployment(entries, environment_short_name):
+    deployments = get_deployments(entries, environment_short_name)
+    if deployments:
+        return deployments[-1]
+
+
+def get_rollback_target(entries, environment_short_name):
+    """Return the last known-good deployment for an environment
+
+    The currently deployed version and any version that ``rollback`` has
+    moved an environment away from are treated as bad. Deployments that
+    did not complete with Green health are skipped. Returns ``None`` if
+    no such deployment has been recorded.
+    """
+    deployments = get_deployments(entries, environment_short_name)
+    if not deployments:
+        return None
+
+    bad_labels = set([deployments[-1]['version_label']])
+    bad_labels.update(entry['rolled_back_from'] for entry in deployments
+                      if entry.get('rolled_back_from'))
+
+    for entry in reversed(deployments):
+        if entry['version_label'] in bad_labels:
+            continue
+        if entry.get('status') == 'complete' and \
+                entry.get('health') == 'Green':
+            return entry
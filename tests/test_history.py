@@ -0,0 +1,149 @@
+import shutil
+import tempfile
+import unittest
+
+from digitalmarketplace.deploy import history
+
+
+def make_history(*deployments):
+    """Build history entries from ``(label, health)`` pairs
+
+    A third item, if present, is the label the deployment rolled back from.
+    """
+    entries = []
+    for deployment in deployments:
+        version_label, health = deployment[:2]
+        rolled_back_from = deployment[2] if len(deployment) > 2 else None
+        entry = history.add_deployment(
+            entries, 'production', version_label,
+            'app', '{}.zip'.format(version_label),
+            rolled_back_from=rolled_back_from)
+        if health is not None:
+            history.complete_deployment(entry, 10, health)
+    return entries
+
+
+def get_target_label(entries):
+    entry = history.get_rollback_target(entries, 'production')
+    if entry is not None:
+        return entry['version_label']
+
+
+class TestLedger(unittest.TestCase):
+    def setUp(self):
+        self._history_dir = history.HISTORY_DIR
+        history.HISTORY_DIR = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(history.HISTORY_DIR)
+        history.HISTORY_DIR = self._history_dir
+
+    def test_load_missing_history(self):
+        self.assertEqual(history.load('app'), [])
+
+    def test_save_and_load(self):
+        entries = make_history(('A', 'Green'))
+        history.save('app', entries)
+
+        self.assertEqual(history.load('app'), entries)
+
+    def test_load_corrupt_history(self):
+        with open(history.get_history_path('app'), 'w') as history_file:
+            history_file.write('[{"environment": ')
+
+        self.assertRaises(ValueError, history.load, 'app')
+
+
+class TestDeployments(unittest.TestCase):
+    def test_add_deployment_is_pending(self):
+        entries = []
+        entry = history.add_deployment(entries, 'staging', 'release-1',
+                                       'app', 'abc123.zip')
+
+        self.assertEqual(entries, [entry])
+        self.assertEqual(entry['sha'], 'abc123')
+        self.assertEqual(entry['status'], 'pending')
+        self.assertIsNone(entry['health'])
+
+    def test_complete_deployment(self):
+        entry = make_history(('A', None))[0]
+        history.complete_deployment(entry, 12.345, 'Green')
+
+        self.assertEqual(entry['status'], 'complete')
+        self.assertEqual(entry['duration'], 12.35)
+        self.assertEqual(entry['health'], 'Green')
+
+    def test_get_sha_from_key(self):
+        self.assertEqual(history.get_sha_from_key('abc123.zip'), 'abc123')
+        self.assertIsNone(history.get_sha_from_key(None))
+
+    def test_get_current_deployment_filters_environment(self):
+        entries = make_history(('A', 'Green'))
+        history.add_deployment(entries, 'staging', 'B', 'app', 'B.zip')
+
+        self.assertEqual(
+            history.get_current_deployment(entries,
+                                           'production')['version_label'],
+            'A')
+        self.assertIsNone(history.get_current_deployment(entries, 'dev'))
+
+
+class TestRollbackTarget(unittest.TestCase):
+    def test_no_history(self):
+        self.assertIsNone(get_target_label([]))
+
+    def test_single_deployment(self):
+        self.assertIsNone(get_target_label(make_history(('A', 'Green'))))
+
+    def test_plain_history(self):
+        entries = make_history(('A', 'Green'), ('B', 'Green'),
+                               ('C', 'Green'))
+
+        self.assertEqual(get_target_label(entries), 'B')
+
+    def test_after_rollback(self):
+        entries = make_history(('A', 'Green'), ('B', 'Green'),
+                               ('C', 'Green'), ('B', 'Green', 'C'))
+
+        self.assertEqual(get_target_label(entries), 'A')
+
+    def test_repeated_rollback(self):
+        entries = make_history(('A', 'Green'), ('B', 'Green'),
+                               ('C', 'Green'), ('B', 'Green', 'C'),
+                               ('A', 'Green', 'B'))
+
+        self.assertIsNone(get_target_label(entries))
+
+    def test_manual_recovery(self):
+        entries = make_history(('A', 'Green'), ('B', 'Red'), ('A', 'Green'))
+
+        self.assertIsNone(get_target_label(entries))
+
+    def test_manual_redeploy_of_healthy_version(self):
+        entries = make_history(('A', 'Green'), ('B', 'Green'),
+                               ('A', 'Green'))
+
+        self.assertEqual(get_target_label(entries), 'B')
+
+    def test_toggling_between_versions(self):
+        entries = make_history(('A', 'Green'), ('B', 'Green'),
+                               ('A', 'Green'), ('B', 'Green'))
+
+        self.assertEqual(get_target_label(entries), 'A')
+
+    def test_skips_unhealthy_deployments(self):
+        entries = make_history(('A', 'Green'), ('B', 'Red'),
+                               ('C', 'Yellow'), ('D', 'Green'))
+
+        self.assertEqual(get_target_label(entries), 'A')
+
+    def test_skips_pending_deployments(self):
+        entries = make_history(('A', 'Green'), ('B', None), ('C', 'Green'))
+
+        self.assertEqual(get_target_label(entries), 'A')
+
+    def test_ignores_other_environments(self):
+        entries = make_history(('A', 'Green'), ('B', 'Green'))
+        history.add_deployment(entries, 'staging', 'C', 'app', 'C.zip')
+
+        self.assertEqual(get_target_label(entries), 'A')